@@ -9,20 +9,35 @@ the file to one that is wrapped appropriately.
 
 import argparse
 import datetime
-import hashlib
-import json
+import functools
+import itertools
+import mmap
 import os
 import re
+import selectors
+import shutil
+import signal
 import tempfile
 import subprocess
 import sys
+import threading
 
-from multiprocessing import Process
+from concurrent.futures import (
+    CancelledError,
+    Future,
+    ProcessPoolExecutor,
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
 
-from typing import Dict, Any, List
+from typing import Callable, Dict, Any, List, Optional
 
 from tqdm import tqdm
 
+import blake3
+import orjson
+
 import coloredlogs
 import logging
 
@@ -31,37 +46,82 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 coloredlogs.install(level="DEBUG", logger=logger)
 
-MD5_BLOCKSIZE = 4 * 1024
+HASH_BLOCKSIZE = 64 * 1024 * 1024
 MONITOR_DELAY = 1.0
 STATUS_COMPLETE = "complete"
-
-
-def md5(fname: str, desc: str = None) -> str:
-    """Calculate the md5 sum of a large file.
-
-    see: https://stackoverflow.com/a/3431838/57626
+VIDEO_EXTS = (".m4v", ".mp4")
+
+# shared settings for the per-file byte progress bars. several of these can
+# be on screen at once, so they repaint at most twice a second.
+PROGRESS_OPTIONS = {
+    "unit": "B",
+    "unit_scale": True,
+    "leave": False,
+    "mininterval": 0.5,
+    "maxinterval": 2.0,
+    "smoothing": 0.05,
+}  # type: Dict[str, Any]
+DEFAULT_JOBS = min(os.cpu_count() or 1, 4)
+
+# a stream copy remux is nearly I/O bound, so ffmpeg doesn't need more than
+# a couple of threads and shouldn't compete with hashing or other jobs
+DEFAULT_FFMPEG_THREADS = 2
+
+# on linux ffmpeg is run at a lower CPU and I/O priority so it yields to
+# interactive work. this uses the lowest best-effort I/O class rather than
+# idle so ffmpeg isn't starved by the hashing running alongside it.
+LOW_PRIORITY_COMMAND = ["nice", "-n", "10", "ionice", "-c", "2", "-n", "7"]
+
+# hashes are always written under HASH_KEY, older metafiles may still carry
+# an md5 sum under one of the LEGACY_HASH_KEYS
+HASH_KEY = "blake3"
+LEGACY_HASH_KEYS = ["md5"]
+
+
+def blake3sum(fname: str, desc: str = None, cancel: Optional[threading.Event] = None) -> str:
+    """Calculate the blake3 hash of a large file.
+
+    BLAKE3 is vectorized and can spread a large update across multiple
+    threads, so it is much faster than md5 for multi-gigabyte videos.
+
+    If `cancel` is set while hashing, CancelledError is raised.
     """
-    hash_md5 = hashlib.md5()
+    hasher = blake3.blake3(max_threads=blake3.blake3.AUTO)
     if desc is None:
-        desc = f"md5 {os.path.basename(fname)}"
-    with tqdm(
-        total=os.path.getsize(fname), unit="B", unit_scale=True, miniters=1, desc=desc, leave=False,
-    ) as pbar:
-        with open(fname, "rb") as f:
-            ctr = 0
-            for chunk in iter(lambda: f.read(MD5_BLOCKSIZE), b""):
-                pbar.update(len(chunk))
-                hash_md5.update(chunk)
-                ctr = ctr + 1
-    return hash_md5.hexdigest()
-
-
+        desc = f"blake3 {os.path.basename(fname)}"
+    with open(fname, "rb") as f:
+        filesize = os.fstat(f.fileno()).st_size
+        if filesize == 0:
+            # mmap can't map an empty file
+            return hasher.hexdigest()
+
+        with tqdm(total=filesize, desc=desc, **PROGRESS_OPTIONS) as pbar:
+            # hash directly out of the mapped file so no data is copied into
+            # python objects, the slabs only exist to drive the progress bar
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm) as view:
+                    for offset in range(0, filesize, HASH_BLOCKSIZE):
+                        if cancel is not None and cancel.is_set():
+                            raise CancelledError(fname)
+                        slab = view[offset : offset + HASH_BLOCKSIZE]
+                        hasher.update(slab)
+                        pbar.update(len(slab))
+                        slab.release()
+    return hasher.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
 def get_ffmpeg_version() -> str:
     """Invoke ffmpeg to return the version string
 
     I found that weird things were happening in the program and that some of
     these issues might've been from different ffmpeg versions. This allows the
     program to fetch the ffmpeg version and record it later.
+
+    The version doesn't change during a run, so ffmpeg is only invoked the
+    first time this is called in each process.
     """
 
     outcommand = [
@@ -94,32 +154,138 @@ def get_blocked_streams(filename: str) -> List[str]:
         sys.exit(1)
 
     out_streams = []  # type: List[str]
-    for stream in json.loads(result.stdout.decode("utf-8")).get("streams", []):
+    for stream in orjson.loads(result.stdout).get("streams", []):
         if stream.get("codec_name", "") in BLOCKED_CODECS:
             out_streams.append(f"0:{stream.get('index')}")
     return out_streams
 
 
-def process_dir(dirname: str) -> None:
-    """Iterate and process the video in a directory."""
+def open_pidfd(pid: int) -> Optional[int]:
+    """Get a file descriptor that becomes readable when a process exits.
+
+    This needs os.pidfd_open, which is only on Linux 5.3+ with Python 3.9+.
+    None is returned everywhere else so the caller can fall back to polling.
+    """
+    if not hasattr(os, "pidfd_open"):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def wait_for_ffmpeg(
+    p: subprocess.Popen, outpath: str, pbar: tqdm, on_tick: Callable[[], None]
+) -> None:
+    """Wait for ffmpeg to exit while following the size of its output.
+
+    `pbar` is updated with the size of `outpath` and `on_tick` is called each
+    time the loop wakes up, including once after ffmpeg has exited.
+    """
+    # wake up as soon as ffmpeg exits, otherwise every MONITOR_DELAY seconds
+    # to update the progress bar
+    pidfd = open_pidfd(p.pid)
+    selector = selectors.DefaultSelector()
+    if pidfd is not None:
+        selector.register(pidfd, selectors.EVENT_READ)
+
+    old_filesize = 0
+    try:
+        while True:
+            if pidfd is not None:
+                if selector.select(timeout=MONITOR_DELAY):
+                    p.wait()
+            else:
+                try:
+                    p.wait(MONITOR_DELAY)
+                except subprocess.TimeoutExpired:
+                    pass
+            try:
+                filesize = os.stat(outpath).st_size
+            except FileNotFoundError:
+                filesize = 0
+            pbar.update(filesize - old_filesize)
+            old_filesize = filesize
+            on_tick()
+            if p.returncode is not None:
+                break
+    finally:
+        selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+def hash_is_current(entry: Dict[str, Any], stat: os.stat_result) -> bool:
+    """Check if a metadata entry has a hash that is still valid for a file.
+
+    An entry records the size and mtime of the file it hashed, if those still
+    match the file can't have changed and doesn't need hashing again. Entries
+    from before these were recorded are trusted as long as they have a hash.
+    """
+    if not any(key in entry for key in [HASH_KEY] + LEGACY_HASH_KEYS):
+        return False
+    return (
+        entry.get("size", stat.st_size) == stat.st_size
+        and entry.get("mtime_ns", stat.st_mtime_ns) == stat.st_mtime_ns
+    )
+
+
+def load_metadata(json_metafile: str) -> Dict[str, Any]:
+    """Read the JSON metadata for a directory.
+
+    The metafile is read with a single read call, and an empty dict is
+    returned if it doesn't exist yet.
+    """
+    try:
+        fd = os.open(json_metafile, os.O_RDONLY)
+    except FileNotFoundError:
+        return {}
+    try:
+        data = os.read(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+    logger.info("metafile '%s' is present", json_metafile)
+    return orjson.loads(data)
+
+
+def save_metadata(json_metafile: str, json_metadata: Dict[str, Any]) -> None:
+    """Atomically write the JSON metadata for a directory.
+
+    The metadata is written to a temporary file that then replaces the
+    metafile, so a crash never leaves a half-written metafile behind.
+    """
+    tmpfile = json_metafile + ".tmp"
+    with open(tmpfile, "wb") as f:
+        f.write(orjson.dumps(json_metadata, option=orjson.OPT_INDENT_2))
+    os.replace(tmpfile, json_metafile)
+
+
+def process_dir(
+    dirname: str,
+    checkpoint: bool = False,
+    ffmpeg_threads: int = DEFAULT_FFMPEG_THREADS,
+    strip_blocked: bool = True,
+) -> None:
+    """Iterate and process the video in a directory.
+
+    The metadata is only written once processing is complete unless
+    `checkpoint` is set, in which case it is also saved as soon as the
+    original file has been hashed and again after the remux finishes.
+    ffmpeg is limited to `ffmpeg_threads` threads. Streams found by
+    `get_blocked_streams` are dropped from the remux if `strip_blocked` is set.
+    """
     logger.info("processing: %s", dirname)
 
     basename = os.path.basename(dirname)
     json_metafile = os.path.join(dirname, f"{basename}.json")
-    json_metadata = {}  # type: Dict[str, Any]
-
-    # check to see if JSON metadata is present
-    if os.path.isfile(json_metafile):
-        logger.info("metafile '%s' is present", json_metafile)
-        json_metadata = json.load(open(json_metafile))
+    json_metadata = load_metadata(json_metafile)
 
     if json_metadata.get("status", "") == STATUS_COMPLETE:
         logger.info("%s is complete", dirname)
         return
 
-    files = [x for x in os.listdir(os.path.join(dirname))]
-
-    videos = [x for x in files if os.path.splitext(x)[1].lower() in [".m4v", ".mp4"]]
+    with os.scandir(dirname) as it:
+        videos = [e.name for e in it if e.name.lower().endswith(VIDEO_EXTS)]
 
     if len(videos) == 0:
         logger.warn("no video files present")
@@ -130,33 +296,70 @@ def process_dir(dirname: str) -> None:
         return
 
     video = videos[0]
+    video_path = os.path.join(dirname, video)
+    video_stat = os.stat(video_path)
+    video_size = video_stat.st_size
     logger.info("working on %s", video)
 
-    # calculate md5sum of original file
-    if "md5" not in json_metadata.get("original", {}):
-        md5sum = md5(os.path.join(dirname, video), desc=f"original md5 {video}")
-        json_metadata["original"] = {
-            "filename": video,
-            "md5": md5sum,
-        }
-
-    with open(json_metafile, "w") as f:
-        json.dump(json_metadata, f)
+    blocked_tracks = []  # type: List[str]
+    if strip_blocked:
+        blocked_tracks = get_blocked_streams(video_path)
+        logger.info("eia_608 tracks: %s", blocked_tracks)
 
-    # run the conversion command
-    outfilename = next(tempfile._get_candidate_names()) + ".mp4"
+    json_metadata["ffmpeg"] = get_ffmpeg_version()
 
-    blocked_tracks = get_blocked_streams(os.path.join(dirname, video))
-    logger.info("eia_608 tracks: %s", blocked_tracks)
+    # hashing is CPU bound while the remux is mostly I/O bound, so the hashes
+    # run on background threads (blake3 releases the GIL) alongside ffmpeg
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=2)
+    original_future = None  # type: Optional[Future]
+    checkpointed = False
+
+    def record_original(future: Optional[Future]) -> None:
+        if future is not None:
+            json_metadata["original"] = {
+                "filename": video,
+                HASH_KEY: future.result(),
+            }
+        json_metadata["original"]["size"] = video_stat.st_size
+        json_metadata["original"]["mtime_ns"] = video_stat.st_mtime_ns
+
+    def checkpoint_original() -> None:
+        # save the original hash as soon as it is known so that it survives
+        # ffmpeg failing or the run being interrupted
+        nonlocal checkpointed
+        if checkpoint and not checkpointed and original_future is not None:
+            if original_future.done():
+                record_original(original_future)
+                save_metadata(json_metafile, json_metadata)
+                checkpointed = True
+
+    # run the conversion command. the output file is reserved up front so
+    # concurrent runs can never pick the same name, and from here on it is
+    # removed again if anything goes wrong so that a failed run doesn't leave
+    # a second video in the directory.
+    # the placeholder is deliberately not preallocated: ffmpeg truncates its
+    # output when it opens it, and the progress bar relies on the file growing.
+    fd, outpath = tempfile.mkstemp(suffix=".mp4", dir=dirname)
+    os.close(fd)
+    outfilename = os.path.basename(outpath)
+    p = None  # type: Optional[subprocess.Popen]
+
+    try:
+        # mkstemp creates the file as owner-only, so give it the same
+        # permissions as the original video
+        shutil.copymode(video_path, outpath)
 
-    def transcode():
         logger.info("writing remuxed file to: %s", outfilename)
         outcommand = [
             "ffmpeg",
+            "-y",
             "-v",
             "warning",
             "-i",
-            os.path.join(dirname, video),
+            video_path,
+            "-threads",
+            str(ffmpeg_threads),
             "-c",
             "copy",
             "-map",
@@ -164,59 +367,78 @@ def process_dir(dirname: str) -> None:
         ]
         for track in blocked_tracks:
             outcommand = outcommand + ["-map", f"-{track}"]
-        outcommand.append(os.path.join(dirname, outfilename))
+        outcommand.append(outpath)
+        if sys.platform.startswith("linux") and shutil.which("ionice"):
+            outcommand = LOW_PRIORITY_COMMAND + outcommand
         logger.info("command: %s", " ".join(outcommand))
-        subprocess.run(outcommand, stdout=sys.stdout.buffer, stderr=sys.stdout.buffer)
-
-    json_metadata["ffmpeg"] = get_ffmpeg_version()
-
-    p = Process(target=transcode)
-    p.start()
-
-    with tqdm(
-        total=os.path.getsize(os.path.join(dirname, video)),
-        unit="B",
-        unit_scale=True,
-        miniters=1,
-        desc=f"ffmpeg {video}",
-        leave=False,
-    ) as pbar:
-        old_filesize = 0
-        while True:
-            p.join(MONITOR_DELAY)
-            if os.path.isfile(os.path.join(dirname, outfilename)):
-                filesize = os.path.getsize(os.path.join(dirname, outfilename))
-                pbar.update(filesize - old_filesize)
-                old_filesize = filesize
-            if p.exitcode is not None:
-                break
-
-    logger.warning("exitcode %d", p.exitcode)
-    # get the final filesize of the output filename
-    if os.path.getsize(os.path.join(dirname, outfilename)) == 0:
-        os.remove(os.path.join(dirname, outfilename))
-        logger.fatal("Converstion error - output file size of %s is 0 bytes", outfilename)
-        sys.exit(1)
-
-    json_metadata["new"] = {"filename": outfilename}
-
-    # incrementally save the metadata
-    with open(json_metafile, "w") as f:
-        json.dump(json_metadata, f)
-
-    logger.info("calculating remuxed md5")
-    md5sum = md5(os.path.join(dirname, outfilename), desc=f"converted md5 {video}")
-    json_metadata["new"]["md5"] = md5sum
-
-    # rename the files
-    original_moved = video + ".orig"
-    os.rename(os.path.join(dirname, video), os.path.join(dirname, original_moved))
-    json_metadata["original"]["target"] = original_moved
+        p = subprocess.Popen(outcommand, stdout=sys.stdout.buffer, stderr=sys.stdout.buffer)
+
+        # calculate hash of original file unless a recorded one (possibly a
+        # legacy md5 sum) is still valid
+        if hash_is_current(json_metadata.get("original", {}), video_stat):
+            logger.info("reusing recorded hash for %s", video)
+        else:
+            original_future = executor.submit(
+                blake3sum, video_path, desc=f"original blake3 {video}", cancel=cancel
+            )
+
+        with tqdm(total=video_size, desc=f"ffmpeg {video}", **PROGRESS_OPTIONS) as pbar:
+            wait_for_ffmpeg(p, outpath, pbar, checkpoint_original)
+
+        logger.warning("exitcode %d", p.returncode)
+        if p.returncode != 0:
+            os.remove(outpath)
+            logger.fatal("Conversion error - ffmpeg exit code is %d", p.returncode)
+            sys.exit(1)
+
+        # get the final filesize of the output filename
+        new_stat = os.stat(outpath)
+        if new_stat.st_size == 0:
+            os.remove(outpath)
+            logger.fatal("Converstion error - output file size of %s is 0 bytes", outfilename)
+            sys.exit(1)
+
+        logger.info("calculating remuxed blake3")
+        new_future = executor.submit(
+            blake3sum, outpath, desc=f"converted blake3 {video}", cancel=cancel
+        )
+
+        record_original(original_future)
+        json_metadata["new"] = {
+            "filename": outfilename,
+            "size": new_stat.st_size,
+            "mtime_ns": new_stat.st_mtime_ns,
+        }
 
-    new_moved = os.path.join(dirname, os.path.basename(dirname) + ".mp4")
-    os.rename(os.path.join(dirname, outfilename), new_moved)
-    logger.info("renamed %s to %s", os.path.join(dirname, outfilename), new_moved)
-    json_metadata["new"]["target"] = os.path.basename(new_moved)
+        if checkpoint:
+            save_metadata(json_metafile, json_metadata)
+
+        json_metadata["new"][HASH_KEY] = new_future.result()
+
+        # rename the files
+        original_moved = video + ".orig"
+        os.replace(video_path, os.path.join(dirname, original_moved))
+        json_metadata["original"]["target"] = original_moved
+
+        new_moved = os.path.join(dirname, basename + ".mp4")
+        os.replace(outpath, new_moved)
+        logger.info("renamed %s to %s", outpath, new_moved)
+        json_metadata["new"]["target"] = os.path.basename(new_moved)
+    except BaseException:
+        # don't leave ffmpeg running, or its partial output behind, if
+        # anything failed or the run was interrupted
+        if p is not None:
+            p.kill()
+            p.wait()
+        try:
+            os.remove(outpath)
+        except FileNotFoundError:
+            pass
+        raise
+    finally:
+        # don't leave a hash running in the background either
+        cancel.set()
+        executor.shutdown(cancel_futures=True)
 
     # add in the metadata to show when the task was completed
     # this stores the timestamp as an int and an isoformat string with timezone
@@ -225,16 +447,39 @@ def process_dir(dirname: str) -> None:
     json_metadata["timestamp"] = int(completion_time.timestamp())
     json_metadata["isotimestamp"] = completion_time.astimezone().isoformat(timespec="seconds")
 
-    with open(json_metafile, "w") as f:
-        json.dump(json_metadata, f)
+    save_metadata(json_metafile, json_metadata)
+
+
+def disable_file_progress() -> None:
+    """Turn off the per-file progress bars in this process.
 
+    This is the initializer for the worker processes when directories are
+    processed in parallel. Bars drawn from several processes would overwrite
+    each other, so only the total progress bar is shown.
+    """
+    PROGRESS_OPTIONS["disable"] = True
+
+
+def exit_on_sigterm(signum: int, frame: Any) -> None:
+    """Turn SIGTERM into SystemExit so that cleanup code gets to run."""
+    sys.exit(128 + signum)
 
-def main(dirname: str = ".") -> None:
+
+def main(
+    dirname: str = ".",
+    jobs: int = DEFAULT_JOBS,
+    checkpoint: bool = False,
+    ffmpeg_threads: int = DEFAULT_FFMPEG_THREADS,
+    strip_blocked: bool = True,
+) -> None:
     """Iterate through all the directories.
 
     Because there isn't a way to know ahead of time if we need to look at the
     files in a directory, the directories are iterated through. This means that
     even junk directories are counted as part of the list.
+
+    Each directory is independent of the others, so up to `jobs` directories
+    are processed at the same time in separate processes.
     """
 
     if not (os.path.isdir(dirname)):
@@ -244,14 +489,42 @@ def main(dirname: str = ".") -> None:
     logger.info("working in directory %s", dirname)
 
     ansi = {"BOLD": "\033[1m", "RED": "\033[91m", "END": "\033[0m"}
-    dirs = [
-        os.path.join(dirname, x)
-        for x in os.listdir(dirname)
-        if os.path.isdir(os.path.join(dirname, x))
-    ]
-    dirs = sorted(dirs)
-    for this_dir in tqdm(dirs, desc="{BOLD}{RED}Total Progress{END}".format(**ansi)):
-        process_dir(this_dir)
+    # DirEntry.is_dir() can usually answer from the directory listing itself
+    # without a stat call per entry
+    with os.scandir(dirname) as it:
+        dirs = sorted(e.path for e in it if e.is_dir())
+    desc = "{BOLD}{RED}Total Progress{END}".format(**ansi)
+    options = {
+        "checkpoint": checkpoint,
+        "ffmpeg_threads": ffmpeg_threads,
+        "strip_blocked": strip_blocked,
+    }  # type: Dict[str, Any]
+
+    if jobs <= 1:
+        for this_dir in tqdm(dirs, desc=desc):
+            process_dir(this_dir, **options)
+        return
+
+    # directories are only handed to the pool as workers free up. the executor
+    # queues submitted work ahead of the workers where it can't be cancelled,
+    # so submitting everything up front would keep going after a failure.
+    pending = iter(dirs)
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=disable_file_progress)
+    with executor, tqdm(total=len(dirs), desc=desc) as pbar:
+        running = {
+            executor.submit(process_dir, this_dir, **options)
+            for this_dir in itertools.islice(pending, jobs)
+        }
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                # re-raise any error, including sys.exit, from the worker. this
+                # stops the batch like a serial run, only the directories that
+                # are already running are left to finish.
+                future.result()
+                pbar.update()
+            for this_dir in itertools.islice(pending, len(done)):
+                running.add(executor.submit(process_dir, this_dir, **options))
 
 
 if __name__ == "__main__":
@@ -261,6 +534,52 @@ if __name__ == "__main__":
         "dirname", action="store", default=os.getcwd(), nargs="?", help="directory to work within",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        action="store",
+        type=int,
+        default=DEFAULT_JOBS,
+        help=f"number of directories to process in parallel (default: {DEFAULT_JOBS})",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="also save the metadata once the original file is hashed and after the remux",
+    )
+
+    parser.add_argument(
+        "--ffmpeg-threads",
+        action="store",
+        type=int,
+        default=DEFAULT_FFMPEG_THREADS,
+        help=f"number of threads each ffmpeg may use (default: {DEFAULT_FFMPEG_THREADS})",
+    )
+
+    parser.add_argument(
+        "--strip-blocked",
+        action="store_true",
+        dest="strip_blocked",
+        default=True,
+        help="drop eia_608 closed caption streams from the remux (default)",
+    )
+
+    parser.add_argument(
+        "--no-strip-blocked",
+        action="store_false",
+        dest="strip_blocked",
+        help="keep every stream in the remux",
+    )
+
     args = parser.parse_args()
 
-    main(dirname=args.dirname)
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+    main(
+        dirname=args.dirname,
+        jobs=args.jobs,
+        checkpoint=args.checkpoint,
+        ffmpeg_threads=args.ffmpeg_threads,
+        strip_blocked=args.strip_blocked,
+    )